@@ -1,26 +1,61 @@
 import os
+import asyncio
+import uuid
+import hashlib
+import time
+import logging
+from contextlib import asynccontextmanager
+from collections import defaultdict
 from datetime import datetime, timedelta
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+import aiofiles
+from cachetools import TTLCache
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from models import ContactMessage, Project, Admin, SessionLocal
+from pydantic import BaseModel, ConfigDict, EmailStr
+from models import ContactMessage, Project, Admin, SessionLocal, get_db, init_db, with_strict_loads
 from starlette.requests import Request
 
 # ✅ Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ✅ Load SECRET_KEY from .env
 SECRET_KEY = os.getenv("SECRET_KEY", "fallback_secret_key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-app = FastAPI()
+# ✅ List Endpoint Page Sizes
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+@asynccontextmanager
+async def lifespan(app):
+    global _contact_flusher
+    await init_db()
+    if CONTACT_BATCHING:
+        _contact_flusher = asyncio.create_task(flush_contact_messages())
+    yield
+    # Let the flusher write everything queued before the sentinel, but give up at the deadline
+    if _contact_flusher:
+        try:
+            await asyncio.wait_for(stop_contact_flusher(), CONTACT_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            _contact_flusher.cancel()
+            logger.error("Shutting down with %d contact messages still queued", _contact_queue.qsize())
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 def read_root():
@@ -29,10 +64,55 @@ def read_root():
 
 # ✅ Ensure `uploads` directory exists
 UPLOAD_DIR = "uploads"
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Stream uploads to disk 1 MB at a time
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # Reject images larger than 10 MB
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + 1024 * 1024  # Image plus room for the other form fields
+IMAGE_SIGNATURES = {b"\x89PNG\r\n\x1a\n": ".png", b"\xff\xd8\xff": ".jpg"}  # Magic bytes -> extension
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# ✅ Serve uploaded files
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# ✅ Serve uploaded files (names are random UUIDs and never rewritten, so let clients cache them forever)
+class ImmutableStaticFiles(StaticFiles):
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+app.mount("/uploads", ImmutableStaticFiles(directory=UPLOAD_DIR), name="uploads")
+
+# ✅ Cap request bodies before Starlette parses (and spools) them: reject on Content-Length up
+# front, and stop reading bodies without one as soon as they pass the limit. Registered before
+# CORS so CORSMiddleware wraps it and the early 413 still carries CORS headers
+class BodySizeLimitMiddleware:
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": "Request too large"}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised while the route parses the form; FastAPI re-raises HTTPException from
+                    # body parsing (rather than turning it into a 400), so this surfaces as a 413
+                    raise HTTPException(status_code=413, detail="Request too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
 
 # ✅ Enable CORS
 app.add_middleware(
@@ -43,25 +123,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ✅ Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# ✅ Compress larger API responses (list endpoints return big JSON arrays); uploaded
+# images are already compressed, so /uploads is passed through untouched
+class APIGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/uploads/"):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(APIGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# ✅ Password Hashing (cost pinned so an interactive login stays under ~100 ms)
+BCRYPT_ROUNDS = 10
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS, deprecated="auto")
+_DUMMY_HASH = pwd_context.hash("dummy")  # Verified against for unknown usernames
 
 # ✅ OAuth2
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# ✅ Database Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# ✅ Admin Lookup Cache (the JWT already vouches for the username; just re-check it exists every 60 s)
+ADMIN_CACHE_TTL_SECONDS = 60
+_admin_cache = TTLCache(maxsize=1024, ttl=ADMIN_CACHE_TTL_SECONDS)
+_admin_locks = defaultdict(asyncio.Lock)  # Keyed by verified JWT subjects only, so bounded by admin count
+
+# ✅ Decoded Token Cache (keyed by a token digest so raw tokens aren't kept in memory)
+_token_cache = TTLCache(maxsize=4096, ttl=60)
 
 # ✅ Authentication Helpers
-def authenticate_admin(username: str, password: str, db: Session):
-    admin = db.query(Admin).filter(Admin.username == username).first()
-    if not admin or not pwd_context.verify(password, admin.password_hash):
+async def authenticate_admin(username: str, password: str, db: AsyncSession):
+    result = await db.execute(select(Admin).where(Admin.username == username))
+    admin = result.scalar_one_or_none()
+    # Always run exactly one bcrypt verify so unknown usernames and bad passwords take the same time
+    target_hash = admin.password_hash if admin else _DUMMY_HASH
+    ok, new_hash = await asyncio.to_thread(pwd_context.verify_and_update, password, target_hash)
+    if not admin or not ok:
         return None
+    if new_hash:
+        # Re-hash at the pinned cost (e.g. admins created under passlib's default of 12 rounds)
+        admin.password_hash = new_hash
+        await db.commit()
     return admin
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -70,75 +170,210 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def decode_access_token(token: str):
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _token_cache.get(key)
+    # Never serve a cached payload past the token's own expiry
+    if payload is None or payload.get("exp", 0) <= time.time():
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        _token_cache[key] = payload
+    return payload
+
 # ✅ Secure Admin Authentication
-def get_current_admin(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_admin(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if not username:
             raise HTTPException(status_code=401, detail="Invalid authentication")
-        admin = db.query(Admin).filter(Admin.username == username).first()
-        if not admin:
-            raise HTTPException(status_code=401, detail="Invalid authentication")
+        admin = _admin_cache.get(username)
+        if admin is None:
+            async with _admin_locks[username]:
+                admin = _admin_cache.get(username)
+                if admin is None:
+                    result = await db.execute(select(Admin).where(Admin.username == username))
+                    admin = result.scalar_one_or_none()
+                    if not admin:
+                        raise HTTPException(status_code=401, detail="Invalid authentication")
+                    _admin_cache[username] = admin
         return admin
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication")
 
 # ✅ Contact Form Pydantic Model
 class ContactForm(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, str_max_length=10_000, extra="forbid", frozen=True)
+
+    name: str
+    email: EmailStr
+    message: str
+
+# ✅ Contact Message Response Model
+class MessageOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
     name: str
     email: str
     message: str
+    timestamp: datetime
+
+# ✅ Contact Message Page (keyset pagination: pass next_cursor back as before_id)
+class MessagePage(BaseModel):
+    items: list[MessageOut]
+    next_cursor: int | None
+
 # ✅ Admin Create Pydantic Model
 class AdminCreate(BaseModel):
     username: str
     password: str
 
     
+# ✅ Contact Message Write Batching (opt-in with CONTACT_BATCHING=true: messages are acknowledged
+# before they are written, so a crash can lose whatever is still queued)
+CONTACT_BATCHING = os.getenv("CONTACT_BATCHING", "false").lower() == "true"
+CONTACT_BATCH_MAX = 500
+CONTACT_BATCH_WAIT_SECONDS = 0.25
+CONTACT_QUEUE_MAX = 5000  # Beyond this, shed load with 503 instead of growing memory
+CONTACT_RETRY_MAX_SECONDS = 30
+CONTACT_SHUTDOWN_TIMEOUT_SECONDS = 10
+_contact_queue = asyncio.Queue(maxsize=CONTACT_QUEUE_MAX)
+_contact_flusher = None
+
+# Wait for one queued message, then keep collecting for up to CONTACT_BATCH_WAIT_SECONDS.
+# Returns the batch and whether the shutdown sentinel (None) was seen.
+async def drain_contact_queue():
+    loop = asyncio.get_running_loop()
+    batch = []
+    item = await _contact_queue.get()
+    deadline = loop.time() + CONTACT_BATCH_WAIT_SECONDS
+    while item is not None:
+        batch.append(item)
+        remaining = deadline - loop.time()
+        if len(batch) >= CONTACT_BATCH_MAX or remaining <= 0:
+            return batch, False
+        try:
+            item = await asyncio.wait_for(_contact_queue.get(), remaining)
+        except asyncio.TimeoutError:
+            return batch, False
+    return batch, True
+
+# Connection-level failures that may succeed on retry; anything else (e.g. a row Postgres
+# rejects, like text containing \x00) fails the same way every time
+def is_transient_db_error(exc):
+    if isinstance(exc, (OperationalError, InterfaceError, PoolTimeoutError, OSError)):
+        return True
+    return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+# Retry transient failures with backoff; meanwhile the bounded queue fills up and
+# save_message starts answering 503. Permanent errors are raised to the caller.
+async def insert_contact_rows(rows):
+    delay = 0.5
+    while True:
+        try:
+            async with SessionLocal() as db:
+                await db.execute(insert(ContactMessage), rows)
+                await db.commit()
+            return
+        except Exception as exc:
+            if not is_transient_db_error(exc):
+                raise
+            logger.warning("Failed to write %d contact messages, retrying in %.1fs", len(rows), delay, exc_info=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CONTACT_RETRY_MAX_SECONDS)
+
+async def write_contact_batch(batch):
+    try:
+        await insert_contact_rows(batch)
+        return
+    except Exception:
+        logger.exception("Batch of %d contact messages rejected, writing them one at a time", len(batch))
+    # Only the rows the database refuses are dropped, not the whole batch
+    for row in batch:
+        try:
+            await insert_contact_rows([row])
+        except Exception:
+            logger.exception("Dropping contact message from %s received at %s", row["email"], row["timestamp"])
+
+async def flush_contact_messages():
+    while True:
+        batch, stop = await drain_contact_queue()
+        if batch:
+            await write_contact_batch(batch)
+        if stop:
+            return
+
+async def stop_contact_flusher():
+    await _contact_queue.put(None)
+    await _contact_flusher
+
 # ✅ Contact Form API
 @app.post("/contact/")
-def save_message(contact: ContactForm, db: Session = Depends(get_db)):
+async def save_message(contact: ContactForm, db: AsyncSession = Depends(get_db)):
+    if _contact_flusher:
+        try:
+            _contact_queue.put_nowait({
+                "name": contact.name,
+                "email": contact.email,
+                "message": contact.message,
+                "timestamp": datetime.utcnow(),  # Receive time, not whenever the batch lands
+            })
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Too many messages, please try again later")
+        return {"message": "Message received"}
+
     new_message = ContactMessage(
         name=contact.name, 
         email=contact.email, 
-        message=contact.message,
-        timestamp=datetime.utcnow()
+        message=contact.message
     )
     db.add(new_message)
-    db.commit()
+    await db.commit()
     return {"message": "Message received"}
 
 # ✅ Securely Retrieve Contact Messages (Admins Only)
-@app.get("/contact/")
-def get_messages(db: Session = Depends(get_db), admin: Admin = Depends(get_current_admin)):
-    messages = db.query(ContactMessage).all()
-    return [
-        {
-            "id": msg.id,
-            "name": msg.name,
-            "email": msg.email,
-            "message": msg.message,
-            "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        for msg in messages
-    ]
+@app.get("/contact/", response_model=MessagePage)
+async def get_messages(
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    before_id: int | None = None,
+    db: AsyncSession = Depends(get_db),
+    admin: Admin = Depends(get_current_admin)
+):
+    stmt = select(
+        ContactMessage.id,
+        ContactMessage.name,
+        ContactMessage.email,
+        ContactMessage.message,
+        ContactMessage.timestamp,
+    ).order_by(ContactMessage.id.desc()).limit(limit)
+    if before_id is not None:
+        stmt = stmt.where(ContactMessage.id < before_id)
+    items = (await db.execute(stmt)).all()
+    next_cursor = items[-1].id if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 # ✅ Admin Registration (Only Run Once)
 @app.post("/register-admin/")
-def register_admin(admin_data: AdminCreate, db: Session = Depends(get_db)):
-    if db.query(Admin).filter(Admin.username == admin_data.username).first():
+async def register_admin(admin_data: AdminCreate, db: AsyncSession = Depends(get_db)):
+    hashed_password = await asyncio.to_thread(pwd_context.hash, admin_data.password)
+
+    # Single round-trip: the unique index on username does the duplicate check atomically
+    stmt = (
+        insert(Admin)
+        .values(username=admin_data.username, password_hash=hashed_password)
+        .on_conflict_do_nothing(index_elements=["username"])
+        .returning(Admin.id)
+    )
+    result = await db.execute(stmt)
+    if result.first() is None:
         raise HTTPException(status_code=400, detail="Admin already exists")
-
-    hashed_password = pwd_context.hash(admin_data.password)
-    new_admin = Admin(username=admin_data.username, password_hash=hashed_password)
-    db.add(new_admin)
-    db.commit()
+    await db.commit()
     return {"message": "Admin created successfully"}
 
 # ✅ Login
 @app.post("/token/")
-def login_admin(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    admin = authenticate_admin(form_data.username, form_data.password, db)
+async def login_admin(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    admin = await authenticate_admin(form_data.username, form_data.password, db)
     if not admin:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
@@ -147,16 +382,31 @@ def login_admin(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
 
 # ✅ Project Model
 class ProjectSchema(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, str_max_length=10_000, extra="forbid", frozen=True)
+
     title: str
     description: str
     image_url: str
 
-@app.post("/projects/")
+# ✅ Project Response Models (serialized by pydantic-core straight from the ORM rows)
+class ProjectOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    title: str
+    description: str
+    image_url: str
+
+class ProjectPage(BaseModel):
+    items: list[ProjectOut]
+    next_cursor: int | None
+
+@app.post("/projects/", response_model=ProjectOut)
 async def create_project(
     title: str = Form(...),
     description: str = Form(...),
     image: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     request: Request = None
 ):
     # Validate image
@@ -164,56 +414,91 @@ async def create_project(
     if image.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Invalid image format")
 
-    # Save file
-    file_location = f"{UPLOAD_DIR}/{image.filename}"
-    with open(file_location, "wb") as buffer:
-        buffer.write(await image.read())
-
-    # Create dynamic URL
-    base_url = str(request.base_url).strip("/")
-    image_url = f"{base_url}/uploads/{image.filename}"
+    # Check the actual file contents, not just the client-supplied content type
+    chunk = await image.read(UPLOAD_CHUNK_SIZE)
+    ext = next((ext for sig, ext in IMAGE_SIGNATURES.items() if chunk.startswith(sig)), None)
+    if not ext:
+        raise HTTPException(status_code=400, detail="Invalid image format")
 
-    # Save to database
-    new_project = Project(title=title, description=description, image_url=image_url)
-    db.add(new_project)
-    db.commit()
-    db.refresh(new_project)
+    # Save file under a generated name, enforcing the size limit while streaming
+    filename = f"{uuid.uuid4().hex}{ext}"
+    file_location = os.path.join(UPLOAD_DIR, filename)
+    total = 0
+    try:
+        async with aiofiles.open(file_location, "wb") as buffer:
+            while chunk:
+                total += len(chunk)
+                if total > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="Image too large")
+                await buffer.write(chunk)
+                chunk = await image.read(UPLOAD_CHUNK_SIZE)
+
+        # Create dynamic URL
+        base_url = str(request.base_url).strip("/")
+        image_url = f"{base_url}/uploads/{filename}"
+
+        # Save to database
+        new_project = Project(title=title, description=description, image_url=image_url)
+        db.add(new_project)
+        await db.commit()
+    except BaseException:
+        # Don't leave orphaned files behind on a 413, a client disconnect or a failed commit
+        if os.path.exists(file_location):
+            os.unlink(file_location)
+        raise
+    await db.refresh(new_project)
     return new_project
 
 # ✅ Get All Projects
-@app.get("/projects/")
-def get_projects(db: Session = Depends(get_db)):
-    return db.query(Project).all()
+@app.get("/projects/", response_model=ProjectPage)
+async def get_projects(
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    before_id: int | None = None,
+    db: AsyncSession = Depends(get_db)
+):
+    stmt = (
+        select(Project.id, Project.title, Project.description, Project.image_url)
+        .order_by(Project.id.desc())
+        .limit(limit)
+    )
+    if before_id is not None:
+        stmt = stmt.where(Project.id < before_id)
+    items = (await db.execute(stmt)).all()
+    next_cursor = items[-1].id if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 # ✅ Get a Single Project
-@app.get("/projects/{project_id}")
-def get_project(project_id: int, db: Session = Depends(get_db)):
-    project = db.query(Project).filter(Project.id == project_id).first()
+@app.get("/projects/{project_id}", response_model=ProjectOut)
+async def get_project(project_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(with_strict_loads(select(Project).where(Project.id == project_id), Project))
+    project = result.scalar_one_or_none()
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     return project
 
 # ✅ Update a Project (Admins Only)
-@app.put("/projects/{project_id}")
-def update_project(project_id: int, project: ProjectSchema, db: Session = Depends(get_db), admin: Admin = Depends(get_current_admin)):
-    db_project = db.query(Project).filter(Project.id == project_id).first()
+@app.put("/projects/{project_id}", response_model=ProjectOut)
+async def update_project(project_id: int, project: ProjectSchema, db: AsyncSession = Depends(get_db), admin: Admin = Depends(get_current_admin)):
+    result = await db.execute(with_strict_loads(select(Project).where(Project.id == project_id), Project))
+    db_project = result.scalar_one_or_none()
     if not db_project:
         raise HTTPException(status_code=404, detail="Project not found")
 
     db_project.title = project.title
     db_project.description = project.description
     db_project.image_url = project.image_url
-    db.commit()
-    db.refresh(db_project)
+    await db.commit()
+    await db.refresh(db_project)
     return db_project
 
 # ✅ Delete a Project (Admins Only)
 @app.delete("/projects/{project_id}")
-def delete_project(project_id: int, db: Session = Depends(get_db), admin: Admin = Depends(get_current_admin)):
-    db_project = db.query(Project).filter(Project.id == project_id).first()
+async def delete_project(project_id: int, db: AsyncSession = Depends(get_db), admin: Admin = Depends(get_current_admin)):
+    result = await db.execute(select(Project).where(Project.id == project_id))
+    db_project = result.scalar_one_or_none()
     if not db_project:
         raise HTTPException(status_code=404, detail="Project not found")
 
-    db.delete(db_project)
-    db.commit()
+    await db.delete(db_project)
+    await db.commit()
     return {"message": "Project deleted successfully"}